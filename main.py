@@ -1,174 +1,173 @@
 import argparse
+import functools
+import multiprocessing
 import os
-import random
-import time
+import pickle
+import re
+import shutil
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
+from typing import TYPE_CHECKING
+
+# Third-party packages are slow to import, so they are imported where they are first needed.
+# This keeps `--help` and runs without any characters fast.
+if TYPE_CHECKING:
+    import numpy as np
+    import requests
+
+
+# Unicode ranges for Chinese characters
+CHINESE_CHAR_RANGES = [
+    (0x4E00, 0x9FFF),  # CJK Unified Ideographs
+    (0x3400, 0x4DBF),  # CJK Unified Ideographs Extension A
+    (0x20000, 0x2A6DF),  # CJK Unified Ideographs Extension B
+    (0x2A700, 0x2B73F),  # CJK Unified Ideographs Extension C
+    (0x2B740, 0x2B81F),  # CJK Unified Ideographs Extension D
+    (0x2B820, 0x2CEAF),  # CJK Unified Ideographs Extension E
+    (0x2CEB0, 0x2EBEF),  # CJK Unified Ideographs Extension F
+    (0x30000, 0x3134F),  # CJK Unified Ideographs Extension G
+    (0x31350, 0x323AF),  # CJK Unified Ideographs Extension H
+    (0x2EBF0, 0x2EE5F),  # CJK Unified Ideographs Extension I
+    (0xF900, 0xFAFF),  # CJK Compatibility Ideographs
+    (0x2F800, 0x2FA1F),  # CJK Compatibility Ideographs Supplement
+]
+
+# Sorted, flattened [start, end + 1) bounds. A code point is inside a range iff it sorts to an odd index.
+_CHINESE_CHAR_BOUNDS = [bound for start, end in sorted(CHINESE_CHAR_RANGES) for bound in (start, end + 1)]
+
+
+def is_chinese_char_mask(chars: list[str]) -> "np.ndarray":
+    """
+    Classify a batch of strings at once.
 
-import pymupdf
-import requests
-from cedict_utils.cedict import CedictEntry, CedictParser
-from pypinyin import pinyin
-
-
-def is_chinese_char(char: str) -> bool:
-    if len(char) != 1:
-        return False
-
-    code_point = ord(char)
-
-    # Unicode ranges for Chinese characters
-    ranges = [
-        (0x4E00, 0x9FFF),  # CJK Unified Ideographs
-        (0x3400, 0x4DBF),  # CJK Unified Ideographs Extension A
-        (0x20000, 0x2A6DF),  # CJK Unified Ideographs Extension B
-        (0x2A700, 0x2B73F),  # CJK Unified Ideographs Extension C
-        (0x2B740, 0x2B81F),  # CJK Unified Ideographs Extension D
-        (0x2B820, 0x2CEAF),  # CJK Unified Ideographs Extension E
-        (0x2CEB0, 0x2EBEF),  # CJK Unified Ideographs Extension F
-        (0x30000, 0x3134F),  # CJK Unified Ideographs Extension G
-        (0x31350, 0x323AF),  # CJK Unified Ideographs Extension H
-        (0x2EBF0, 0x2EE5F),  # CJK Unified Ideographs Extension I
-        (0xF900, 0xFAFF),  # CJK Compatibility Ideographs
-        (0x2F800, 0x2FA1F),  # CJK Compatibility Ideographs Supplement
-    ]
-
-    return any(start <= code_point <= end for start, end in ranges)
+    Returns:
+        np.ndarray: Boolean mask, True where the string is a single Chinese character
+    """
+    import numpy as np
 
+    # Strings that are not exactly one character map to -1, which is outside every range
+    code_points = np.fromiter((ord(c) if len(c) == 1 else -1 for c in chars), dtype=np.int32, count=len(chars))
+    return np.searchsorted(_CHINESE_CHAR_BOUNDS, code_points, side="right") % 2 == 1
 
-def download_binary(url: str, out_path: str):
-    response = requests.get(url)
-    response.raise_for_status()  # Raise an exception for bad responses
 
-    with open(out_path, "wb") as f:
-        f.write(response.content)
+@functools.cache
+def get_session() -> "requests.Session":
+    """
+    Returns:
+        requests.Session: Single session so connections (and TLS handshakes) are reused across downloads
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
 
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+    return session
 
-def download_files(char: str, out_dir: str, no_dl: bool) -> tuple[str, str]:
-    """
-    Download the stroke order image and worksheet PDF for a given Chinese character.
 
-    Args:
-        char (str): The Chinese character to download files for
-        out_dir (str): The directory to save the downloaded files
-        no_dl (bool): If True, skip downloading files
+def download_binary(session: "requests.Session", url: str, out_path: str | Path):
+    with session.get(url, stream=True) as response:
+        response.raise_for_status()  # Raise an exception for bad responses
+        response.raw.decode_content = True  # Undo any gzip/deflate transfer encoding while streaming
 
-    Returns:
-        tuple[str, str]: Paths to the downloaded stroke order image and worksheet PDF
-    """
-    unicode_value = ord(char)
+        # Write to a temporary file first so an interrupted download is never mistaken for a cached one
+        tmp_path = Path(out_path).with_suffix(".part")
+        with open(tmp_path, "wb") as f:
+            shutil.copyfileobj(response.raw, f, 64 * 1024)
+    os.replace(tmp_path, out_path)
 
-    image_url = f"https://www.strokeorder.com/assets/bishun/guide/{unicode_value}.png"
-    image_path = Path(out_dir) / "intermediate" / f"{char}_stroke_order.png"
-    if no_dl:
-        print("...Skipping download of stroke order image")
-    else:
-        print("...Downloading stroke order image")
-        time.sleep(random.uniform(0.1, 1))
-        download_binary(image_url, image_path)
-
-    worksheet_url = f"https://www.strokeorder.com/assets/bishun/worksheets/pdf/2/{unicode_value}.pdf"
-    worksheet_path = Path(out_dir) / "intermediate" / f"{char}_raw_worksheet.pdf"
-    if no_dl:
-        print("...Skipping download of raw worksheet")
-    else:
-        print("...Downloading raw worksheet")
-        time.sleep(random.uniform(0.1, 1))
-        download_binary(worksheet_url, worksheet_path)
 
-    return image_path, worksheet_path
+def is_cached(path: Path) -> bool:
+    return path.exists() and path.stat().st_size > 0
 
 
-def add_text_to_pdf(input_pdf_path: str, text: str, rect: tuple[int, int, int, int], output_pdf_path: str):
+def get_file_paths(char: str, out_dir: Path) -> tuple[Path, Path]:
     """
-    Add text to a PDF file.
-
-    Args:
-        input_pdf_path (str): Path to the input PDF file
-        text (str): Text to add to the PDF
-        rect (tuple[int, int, int, int]): Rectangle coordinates for the text box (x0, y0, x1, y1)
-        output_pdf_path (str): Path to save the modified PDF
+    Returns:
+        tuple[Path, Path]: Paths to the stroke order image and raw worksheet PDF for a given Chinese character
     """
-    doc = pymupdf.open(input_pdf_path)
-    page = doc[0]
-    page.insert_htmlbox(rect, text)
-
-    if input_pdf_path == output_pdf_path:
-        doc.save(output_pdf_path, incremental=True, encryption=0)
-    else:
-        doc.save(output_pdf_path, deflate=True, garbage=3, use_objstms=1)
-    doc.close()
+    image_path = out_dir / "intermediate" / f"{char}_stroke_order.png"
+    worksheet_path = out_dir / "intermediate" / f"{char}_raw_worksheet.pdf"
+    return image_path, worksheet_path
 
 
-def add_image_to_pdf(input_pdf_path: str, image_path: str, output_pdf_path: str):
+def download_files(char: str, out_dir: Path, session: "requests.Session"):
     """
-    Add an image to a PDF file.
+    Download the stroke order image and worksheet PDF for a given Chinese character.
+    Files that were already downloaded by a previous run are reused.
 
     Args:
-        input_pdf_path (str): Path to the input PDF file
-        image_path (str): Path to the image file
-        output_pdf_path (str): Path to save the modified PDF
+        char (str): The Chinese character to download files for
+        out_dir (Path): The directory to save the downloaded files
+        session (requests.Session): Session to download with
     """
-    doc = pymupdf.open(input_pdf_path)
-    page = doc[0]
-    page_rect = page.bound()
-    # Position image in the top right corner
-    image_rect = (page_rect.x1 - 125, 10, page_rect.x1 - 10, 125)
-    page.insert_image(image_rect, filename=image_path)
+    unicode_value = ord(char)
+    image_path, worksheet_path = get_file_paths(char, out_dir)
+    jobs = [
+        (f"https://www.strokeorder.com/assets/bishun/guide/{unicode_value}.png", image_path),
+        (f"https://www.strokeorder.com/assets/bishun/worksheets/pdf/2/{unicode_value}.pdf", worksheet_path),
+    ]
 
-    if input_pdf_path == output_pdf_path:
-        doc.save(output_pdf_path, incremental=True, encryption=0)
-    else:
-        doc.save(output_pdf_path, deflate=True, garbage=3, use_objstms=1)
-    doc.close()
+    for url, path in jobs:
+        if is_cached(path):
+            continue
+        print(f"...Downloading {path.name}")
+        download_binary(session, url, path)
 
 
-def combine_worksheets(input_pdf_paths: list[str], output_pdf_path: str):
+def combine_worksheets(input_pdf_paths: list[str | Path], output_pdf_path: str | Path):
     """
     Combine multiple worksheets into one PDF.
+    The worksheets are already compressed, so their streams are copied as-is rather than recompressed.
     """
-    doc = pymupdf.open()
+    import pymupdf
 
-    for path in input_pdf_paths:
-        with pymupdf.open(path) as temp_doc:
-            doc.insert_pdf(temp_doc)
+    with pymupdf.open() as doc:
+        for path in input_pdf_paths:
+            with pymupdf.open(path) as temp_doc:
+                doc.insert_pdf(temp_doc)
 
-    doc.save(output_pdf_path, deflate=True, garbage=3, use_objstms=1)
-    doc.close()
+        doc.save(output_pdf_path, deflate=False, garbage=1, use_objstms=1)
 
 
 def process_raw_worksheet(
-    raw_worksheet_path: str,
+    raw_worksheet_path: str | Path,
     pinyin: str,
-    stroke_order_image_path: str,
+    stroke_order_image_path: str | Path,
     definitions: list[str],
-    final_worksheet_path: str,
+    final_worksheet_path: str | Path,
 ):
     """
-    Process the raw worksheet PDF by adding pinyin and stroke order image.
+    Process the raw worksheet PDF by adding pinyin, definitions, and stroke order image.
+    All edits are applied to a copy of the raw worksheet and appended to it with a single incremental save.
     """
-    print("...Adding pinyin to worksheet")
-    add_text_to_pdf(
-        input_pdf_path=raw_worksheet_path,
-        text=pinyin,
-        rect=(50, 50, 200, 500),
-        output_pdf_path=final_worksheet_path,
-    )
+    import pymupdf
 
-    print("...Adding definitions to worksheet")
-    definitions_formatted = "<br>".join(definitions)
-    add_text_to_pdf(
-        input_pdf_path=final_worksheet_path,
-        text=definitions_formatted,
-        rect=(50, 495, 800, 800),
-        output_pdf_path=final_worksheet_path,
-    )
+    shutil.copyfile(raw_worksheet_path, final_worksheet_path)
+    with pymupdf.open(final_worksheet_path) as doc:
+        page = doc[0]
 
-    print("...Adding stroke order image")
-    add_image_to_pdf(
-        input_pdf_path=final_worksheet_path,
-        image_path=stroke_order_image_path,
-        output_pdf_path=final_worksheet_path,
-    )
+        print("...Adding pinyin to worksheet")
+        page.insert_htmlbox((50, 50, 200, 500), pinyin)
+
+        print("...Adding definitions to worksheet")
+        definitions_formatted = "<br>".join(definitions)
+        page.insert_htmlbox((50, 495, 800, 800), definitions_formatted)
+
+        print("...Adding stroke order image")
+        page_rect = page.bound()
+        # Position image in the top right corner
+        image_rect = (page_rect.x1 - 125, 10, page_rect.x1 - 10, 125)
+        page.insert_image(image_rect, filename=stroke_order_image_path)
+
+        if doc.can_save_incrementally():
+            # Compress the appended objects here, in the worker, so combining worksheets doesn't have to
+            doc.save(final_worksheet_path, incremental=True, encryption=0, deflate=True)
+            return
+
+        # Repaired files can't be appended to, so rewrite the whole document instead
+        data = doc.tobytes(deflate=True, garbage=3, use_objstms=1)
+
+    Path(final_worksheet_path).write_bytes(data)
 
 
 def read_characters_from_file(file_path: str) -> list[str]:
@@ -177,34 +176,83 @@ def read_characters_from_file(file_path: str) -> list[str]:
     return characters
 
 
-def lookup_chinese(word, entries: list[CedictEntry]) -> list[str]:
+# CEDICT line format: TRADITIONAL SIMPLIFIED [pin1 yin1] /meaning 1/meaning 2/
+_CEDICT_LINE = re.compile(r"^(\S+) (\S+) \[[^\]]*\] /(.*)/\s*$")
+
+
+def parse_cedict(dict_path: str | Path) -> dict[str, list[str]]:
+    """
+    Parse a CEDICT file, mapping both the simplified and traditional form of each entry to its meanings.
+    """
+    index: dict[str, list[str]] = {}
+    with open(dict_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            match = _CEDICT_LINE.match(line)
+            if not match:
+                continue
+
+            traditional, simplified, meanings_str = match.groups()
+            meanings = meanings_str.replace('"', "'").split("/")
+            index.setdefault(simplified, []).extend(meanings)
+            if traditional != simplified:
+                index.setdefault(traditional, []).extend(meanings)
+    return index
+
+
+def load_index(dict_path: str | Path) -> dict[str, list[str]]:
+    """
+    Load the dictionary index, reusing a pickled copy next to the dictionary file if it is up to date.
+    """
+    pickle_path = Path(dict_path).with_suffix(".pkl")
+    if pickle_path.exists() and pickle_path.stat().st_mtime >= os.path.getmtime(dict_path):
+        with open(pickle_path, "rb") as f:
+            return pickle.load(f)
+
+    index = parse_cedict(dict_path)
+    tmp_path = pickle_path.with_suffix(".part")
+    with open(tmp_path, "wb") as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, pickle_path)
+    return index
+
+
+# Definitions that are surnames, variants, classifiers, or slang
+_UNHELPFUL_DEFINITION = re.compile(r"^surname|variant of|CL:|\(slang\)")
+
+
+def lookup_chinese(word, index: dict[str, list[str]]) -> list[str]:
     """
     Returns the first three definitions for a given Chinese word. Filters out some less helpful definitions.
     """
-    results: list[str] = []
-    for entry in entries:
-        if entry.traditional == word or entry.simplified == word:
-            results.extend(entry.meanings)
+    results: list[str] = index.get(word, [])
 
     # Filter results
-    filtered_results = []
-    for result in results:
-        if result.startswith("surname"):
-            continue
-        if "variant of" in result:
-            continue
-        if "CL:" in result:
-            continue
-        if "(slang)" in result:
-            continue
-
-        filtered_results.append(result)
+    filtered_results = [result for result in results if not _UNHELPFUL_DEFINITION.search(result)]
 
     return filtered_results[:3]
 
 
+def _process_one(char: str, pinyin_str: str, definitions: list[str], out_dir: Path) -> Path:
+    """
+    Create the final worksheet for a single character from its downloaded files. Runs in a worker process,
+    so it takes the already looked-up pinyin and definitions and does no dictionary or pinyin lookups of its own.
+
+    Returns:
+        Path: Path to the final worksheet PDF
+    """
+    print(f'Processing "{char}":')
+    final_worksheet_path = out_dir / "intermediate" / f"worksheet_{char}.pdf"
+
+    image_path, raw_worksheet_path = get_file_paths(char, out_dir)
+    process_raw_worksheet(raw_worksheet_path, pinyin_str, image_path, definitions, final_worksheet_path)
+
+    return final_worksheet_path
+
+
 def main():
-    out_dir = "output"
+    out_dir = Path("output")
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--characters", nargs="*", default=[], help="Chinese characters to process")
@@ -223,10 +271,6 @@ def main():
     )
     args = parser.parse_args()
 
-    # Parse the dictionary file
-    parser = CedictParser(file_path="data/cedict_1_0_ts_utf-8_mdbg.txt")
-    entries: list[CedictEntry] = parser.parse()
-
     characters: list[str] = []
     for file in args.files:
         characters.extend(read_characters_from_file(file))
@@ -236,27 +280,62 @@ def main():
         print("No characters provided. Exiting.")
         return
 
-    worksheet_paths = []
-    for char in set(characters):
-        if not is_chinese_char(char):
+    # Deduplicate while keeping input order, so the combined worksheet follows the order characters were given in
+    unique_characters = list(dict.fromkeys(characters))
+    mask = is_chinese_char_mask(unique_characters)
+    chars = []
+    for char, is_chinese in zip(unique_characters, mask):
+        if not is_chinese:
             print(f"'{char}' is not a Chinese character or has more than one character per line.")
             continue
+        chars.append(char)
 
-        print(f'Processing "{char}":')
-        final_worksheet_path = Path(out_dir) / "intermediate" / f"worksheet_{char}.pdf"
-        os.makedirs(final_worksheet_path.parent, exist_ok=True)
-        worksheet_paths.append(final_worksheet_path)
-
-        pinyin_str = " ".join([p[0] for p in pinyin(char)])
-        definitions = lookup_chinese(char, entries)
-
-        image_path, raw_worksheet_path = download_files(char, out_dir, args.no_dl)
-        process_raw_worksheet(raw_worksheet_path, pinyin_str, image_path, definitions, final_worksheet_path)
+    # Parse the dictionary file
+    index = load_index("data/cedict_1_0_ts_utf-8_mdbg.txt")
+
+    # Look up pinyin for all characters in one call. Passing a list keeps each character as its own
+    # segment, so readings are not influenced by neighboring characters forming a phrase.
+    from pypinyin import pinyin
+
+    pinyin_strs = [p[0] for p in pinyin(chars)]
+
+    definitions = [lookup_chinese(char, index) for char in chars]
+
+    os.makedirs(out_dir / "intermediate", exist_ok=True)
+
+    # Downloading is network-bound and editing the PDFs is CPU-bound, so run them as a pipeline: each character's
+    # worksheet is edited in a worker process as soon as its files are downloaded, while other downloads continue.
+    # Workers are started from a forkserver (or spawned where that isn't available, e.g. on Windows) rather than
+    # forked, since forking while download threads are running can leave a worker holding a lock (e.g. for stdout)
+    # that it will never be able to acquire
+    max_workers = min(os.cpu_count() or 1, 4)
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    mp_context = multiprocessing.get_context(start_method)
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context) as process_executor:
+        tasks = list(zip(chars, pinyin_strs, definitions))
+        process_futures: dict[int, Future[Path]] = {}
+        if args.no_dl:
+            print("Skipping download of stroke order images and raw worksheets")
+            for i, task in enumerate(tasks):
+                process_futures[i] = process_executor.submit(_process_one, *task, out_dir)
+        else:
+            session = get_session()
+            with ThreadPoolExecutor(max_workers=8) as download_executor:
+                download_futures = {
+                    download_executor.submit(download_files, char, out_dir, session): i
+                    for i, char in enumerate(chars)
+                }
+                for download_future in as_completed(download_futures):
+                    download_future.result()  # Raise any download error
+                    i = download_futures[download_future]
+                    process_futures[i] = process_executor.submit(_process_one, *tasks[i], out_dir)
+
+        worksheet_paths = [process_futures[i].result() for i in range(len(chars))]
 
     print("Combining all worksheets into one...")
-    combined_worksheet_path = Path(out_dir) / "combined" / f"{args.name}.pdf"
+    combined_worksheet_path = out_dir / "combined" / f"{args.name}.pdf"
     os.makedirs(combined_worksheet_path.parent, exist_ok=True)
-    combine_worksheets(worksheet_paths, Path(out_dir) / "combined" / f"{args.name}.pdf")
+    combine_worksheets(worksheet_paths, combined_worksheet_path)
 
 
 if __name__ == "__main__":